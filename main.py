@@ -6,13 +6,37 @@ import os
 import re
 import uuid
 import json
-import shutil
+import queue
+import atexit
+import threading
 import datetime
 import subprocess
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter, Retry
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
 
+# ========================================
+# Shared HTTP session (keep-alive + retries)
+# ========================================
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20,
+                                      max_retries=Retry(total=3, backoff_factor=0.3)))
+
+# The storage hosts see concurrent PUTs from the upload pool plus the
+# background downloader — size their pools so no worker waits for a slot.
+# PUT is retried too: the uploads are idempotent and urllib3 rewinds the
+# seekable file body before replaying after a 5xx.
+_storage_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                               max_retries=Retry(total=3, backoff_factor=0.3,
+                                                 status_forcelist=(500, 502, 503, 504),
+                                                 allowed_methods=frozenset({"GET", "HEAD", "PUT"})))
+SESSION.mount("https://storage.bunnycdn.com/", _storage_adapter)
+SESSION.mount("https://firebasestorage.googleapis.com/", _storage_adapter)
+atexit.register(SESSION.close)
+
 # ========================================
 # Load environment variables
 # ========================================
@@ -41,20 +65,37 @@ if bunny_json:
 else:
     BUNNY_STORAGE_ZONE = BUNNY_API_KEY = BUNNY_PULL_ZONE_URL = None
 
+# Constant across every upload — validate the config and build the header
+# dict once at startup instead of per call
+if BUNNY_STORAGE_ZONE and BUNNY_API_KEY and BUNNY_PULL_ZONE_URL:
+    BUNNY_HEADERS = {
+        "AccessKey": BUNNY_API_KEY,
+        "Content-Type": "application/octet-stream"
+    }
+else:
+    BUNNY_HEADERS = None
+
 # ========================================
 # Initialize Firebase apps
 # ========================================
-if not firebase_admin._apps:
+# _apps is keyed by app name, so membership checks need no name scan
+if "main_app" not in firebase_admin._apps:
     firebase_admin.initialize_app(credentials.Certificate(main_cred_dict), {
         "storageBucket": f"{main_cred_dict['project_id']}.appspot.com"
     }, name="main_app")
 
-if "log_app" not in [app.name for app in firebase_admin._apps.values()]:
+if "log_app" not in firebase_admin._apps:
     firebase_admin.initialize_app(credentials.Certificate(log_cred_dict), name="log_app")
 
-db = firestore.client(firebase_admin.get_app("main_app"))
-bucket = storage.bucket(app=firebase_admin.get_app("main_app"))
-verify_db = firestore.client(firebase_admin.get_app("log_app"))
+MAIN_APP = firebase_admin.get_app("main_app")
+LOG_APP = firebase_admin.get_app("log_app")
+
+db = firestore.client(MAIN_APP)
+bucket = storage.bucket(app=MAIN_APP)
+verify_db = firestore.client(LOG_APP)
+
+# Invariant across every upload — build it once instead of per call
+BUCKET_URL_BASE = f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/"
 
 print(f"🔥 Connected to main DB: {main_cred_dict['project_id']}")
 print(f"📜 Connected to log DB for {bot_id}")
@@ -65,69 +106,176 @@ print(f"📜 Connected to log DB for {bot_id}")
 today_str = datetime.datetime.now().strftime("%Y-%m-%d")
 log_collection = verify_db.collection(today_str)
 bot_doc = log_collection.document(bot_id)
-bot_snapshot = bot_doc.get()
-
-if not bot_snapshot.exists:
-    bot_doc.set({})
-    bot_data = {}
-    print(f"🆕 Created new daily log for {bot_id}")
-else:
-    bot_data = bot_snapshot.to_dict() or {}
 
-def parse_runtime(rt):
-    try:
-        h, m, s = map(int, rt.replace("H","").replace("M","").replace("S","").split("-"))
-        return h + m/60 + s/3600
-    except:
-        return 0
-
-total_runtime = sum(parse_runtime(v.get("active_time","0H-0M-0S"))
-                    for k,v in bot_data.items() if k.startswith("runtime_"))
+# One small read covers both the daily-limit check and the runtime index —
+# no full-document fetch or create-if-missing round-trips at startup.
+snapshot = bot_doc.get(field_paths=["total_runtime_hours", "runtime_index"])
+fields = snapshot.to_dict() or {}
+total_runtime = fields.get("total_runtime_hours", 0)
 
 if total_runtime >= 5:
     print(f"🛑 {bot_id} already used {total_runtime:.2f}h today — stopping job.")
     raise SystemExit()
 
-runtime_num = sum(1 for k in bot_data if k.startswith("runtime_")) + 1
+runtime_num = fields.get("runtime_index", 0) + 1
 runtime_key = f"runtime_{runtime_num}"
 start_time = datetime.datetime.now()
 
-bot_data[runtime_key] = {
-    "started_at": start_time.isoformat(),
-    "ended_at": "",
-    "active_time": "",
-    "status": "running",
-    "success_count": 0,
-    "fail_count": 0,
-    "total_count": 0,
-    "logs": []
-}
-bot_doc.set(bot_data, merge=True)
+# A single merge write creates the log doc if needed, records the new
+# runtime entry and bumps the server-side index atomically.
+bot_doc.set({
+    "runtime_index": firestore.Increment(1),
+    runtime_key: {
+        "started_at": start_time.isoformat(),
+        "ended_at": "",
+        "active_time": "",
+        "status": "running",
+        "success_count": 0,
+        "fail_count": 0,
+        "total_count": 0,
+        "logs": []
+    }
+}, merge=True)
 print(f"🕒 Started {runtime_key}")
 
 # ========================================
 # Helper Functions
 # ========================================
-def get_video_duration(filename):
-    result = subprocess.run(
-        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-         "-of", "default=noprint_wrappers=1:nokey=1", filename],
-        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-    )
-    return float(result.stdout)
-
-def create_quality_versions(input_file):
-    qualities = {"360p": "640x360", "480p": "854x480", "720p": "1280x720"}
-    output_files = {}
-    os.makedirs("output_videos", exist_ok=True)
+_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+_TIME_RE = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
 
-    for q, res in qualities.items():
-        output_file = f"output_videos/{uuid.uuid4()}-{q}.mp4"
-        cmd = ["ffmpeg", "-y", "-i", input_file, "-vf", f"scale={res}",
-               "-c:v", "libx264", "-preset", "fast", "-c:a", "aac", output_file]
-        subprocess.run(cmd, check=True)
-        output_files[q] = output_file
-    return output_files
+def _encoder_works(codec):
+    # A tiny probe encode: -encoders only proves ffmpeg was built with the
+    # codec, not that the GPU/driver is actually present on this machine.
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-f", "lavfi",
+             "-i", "color=black:s=64x64:d=0.1", "-c:v", codec, "-f", "null", "-"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+        return result.returncode == 0
+    except Exception:
+        return False
+
+def detect_encoder():
+    """Pick a hardware H.264 encoder when ffmpeg can actually use one here."""
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                text=True)
+        encoders = result.stdout
+    except Exception:
+        encoders = ""
+
+    candidates = [
+        ("h264_nvenc", ["-preset", "p4", "-rc", "vbr"]),
+        ("h264_qsv", ["-preset", "medium"]),
+        ("h264_videotoolbox", []),
+    ]
+    for codec, flags in candidates:
+        if codec in encoders and _encoder_works(codec):
+            return codec, flags
+    return "libx264", ["-preset", "fast"]
+
+ENCODER, ENCODER_FLAGS = detect_encoder()
+print(f"🎬 Using video encoder: {ENCODER}")
+
+_QUALITIES = {"360p": "640:360", "480p": "854:480", "720p": "1280:720"}
+
+def _encode(input_arg, stream=None, spool=None):
+    """Run the three-rendition + thumbnail filter graph on one input, which
+    is either a file path or pipe:0 fed from `stream` (tee'd into `spool`)."""
+    output_files = {q: f"output_videos/{uuid.uuid4()}-{q}.mp4" for q in _QUALITIES}
+    thumb_file = f"output_videos/{uuid.uuid4()}-thumbnail.jpg"
+
+    # One decode pass fanned out to the three renditions plus a thumbnail
+    # branch, instead of separate decode+encode runs per output.
+    branches = len(_QUALITIES) + 1
+    filter_parts = [f"[0:v]split={branches}" +
+                    "".join(f"[v{i}]" for i in range(branches))]
+    for i, res in enumerate(_QUALITIES.values()):
+        filter_parts.append(f"[v{i}]scale={res}[o{i}]")
+    # Downscale before thumbnail: the filter buffers its whole frame window,
+    # which at source resolution would cost hundreds of MB of RAM.
+    filter_parts.append(f"[v{len(_QUALITIES)}]scale=640:-2,thumbnail[thumb]")
+
+    cmd = ["ffmpeg", "-y", "-i", input_arg,
+           "-filter_complex", ";".join(filter_parts)]
+    for i, q in enumerate(_QUALITIES):
+        cmd += ["-map", f"[o{i}]", "-map", "0:a?",
+                "-c:v", ENCODER, *ENCODER_FLAGS, "-c:a", "aac",
+                output_files[q]]
+    cmd += ["-map", "[thumb]", "-frames:v", "1", "-update", "1", thumb_file]
+
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.PIPE if stream is not None else subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+
+    # Drain stderr on the side so ffmpeg's progress output can't fill the
+    # pipe buffer and deadlock against our stdin writes.
+    stderr_chunks = []
+    drainer = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()),
+                               daemon=True)
+    drainer.start()
+
+    try:
+        if stream is not None:
+            for chunk in stream:
+                if spool is not None:
+                    spool.write(chunk)
+                try:
+                    proc.stdin.write(chunk)
+                except BrokenPipeError:
+                    break
+            proc.stdin.close()
+        returncode = proc.wait()
+        drainer.join()
+        stderr = b"".join(stderr_chunks).decode(errors="replace")
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+    except BaseException:
+        # A failed feed (e.g. network drop mid-download) or encode must not
+        # leave an orphaned ffmpeg child or its partial outputs behind.
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        for p in (*output_files.values(), thumb_file):
+            if os.path.exists(p):
+                os.remove(p)
+        raise
+
+    # ffmpeg already prints the duration while probing/encoding, so reuse it
+    # instead of a separate ffprobe fork+exec per video. Piped input may not
+    # report Duration up front — fall back to the last progress timestamp.
+    match = _DURATION_RE.search(stderr)
+    hms = match.groups() if match else None
+    if hms is None:
+        times = _TIME_RE.findall(stderr)
+        hms = times[-1] if times else None
+    duration = int(hms[0])*3600 + int(hms[1])*60 + float(hms[2]) if hms else 0.0
+    return output_files, thumb_file, duration
+
+def create_quality_versions(stream):
+    """Encode all renditions plus the thumbnail in one ffmpeg pass, fed from
+    an iterator of byte chunks piped into stdin so encoding starts as soon as
+    the first bytes arrive. Sources the demuxer can't read from a pipe (e.g.
+    MP4s with the moov atom at the end) are retried from a spooled copy."""
+    os.makedirs("output_videos", exist_ok=True)
+    spool_file = f"output_videos/{uuid.uuid4()}-source.mp4"
+    try:
+        with open(spool_file, "wb") as spool:
+            try:
+                return _encode("pipe:0", stream=stream, spool=spool)
+            except subprocess.CalledProcessError:
+                # Finish the download into the spool, then run the same
+                # filter graph from disk where ffmpeg can seek.
+                print("⚠️ Piped encode failed — retrying from disk.")
+                for chunk in stream:
+                    spool.write(chunk)
+        return _encode(spool_file)
+    finally:
+        if os.path.exists(spool_file):
+            os.remove(spool_file)
 
 def upload_to_firebase(file_path, quality=None):
     filename = os.path.basename(file_path)
@@ -139,30 +287,31 @@ def upload_to_firebase(file_path, quality=None):
         path = filename
 
     blob = bucket.blob(path)
-    blob.upload_from_filename(file_path)
-    token = str(uuid.uuid4())
+    token = uuid.uuid4().hex
+    # Attach the download token before uploading so it ships with the upload
+    # request itself, instead of a second PATCH round-trip per file.
     blob.metadata = {"firebaseStorageDownloadTokens": token}
-    blob.patch()
-    
-    url = f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{path.replace('/', '%2F')}?alt=media&token={token}"
+    blob.upload_from_filename(file_path)
+
+
+    url = f"{BUCKET_URL_BASE}{quote(path, safe='')}?alt=media&token={token}"
     return url
 
 def upload_to_bunny(file_path, quality=None):
-    if not (BUNNY_STORAGE_ZONE and BUNNY_API_KEY and BUNNY_PULL_ZONE_URL):
+    if BUNNY_HEADERS is None:
         raise Exception("❌ Missing Bunny configuration")
 
     filename = os.path.basename(file_path)
     path = f"qualities/{quality}/{filename}" if quality else filename
 
     bunny_url = f"https://storage.bunnycdn.com/{BUNNY_STORAGE_ZONE}/{path}"
-    headers = {
-        "AccessKey": BUNNY_API_KEY,
-        "Content-Type": "application/octet-stream"
-    }
 
     print(f"🐰 Uploading to: {bunny_url}")
-    with open(file_path, "rb") as f:
-        response = requests.put(bunny_url, headers=headers, data=f)
+    # Pass the file object itself: requests takes Content-Length from its
+    # size and streams it without chunked encoding, while the 1MB buffer
+    # keeps the reads large.
+    with open(file_path, "rb", buffering=1024*1024) as f:
+        response = SESSION.put(bunny_url, headers=BUNNY_HEADERS, data=f, timeout=60)
 
     if response.status_code not in (200, 201):
         raise Exception(f"Bunny upload failed ({response.status_code}): {response.text}")
@@ -192,59 +341,116 @@ if not unprocessed_docs:
 
 print(f"🎯 Found {len(unprocessed_docs)} videos to process.")
 
-for index, doc in enumerate(unprocessed_docs, start=1):
-    print("="*60)
-    print(f"🚀 Processing {index}/{len(unprocessed_docs)} | ID: {doc.id}")
-    data = doc.to_dict()
-    url = data.get("url")
-    provider = data.get("storageProvider","Firebase")  # default Firebase
-
-    if not url:
-        print(f"⚠️ Missing URL in {doc.id}")
-        continue
-
-    # Download
-    video_file = "input.mp4"
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(video_file, "wb") as f:
-            for chunk in r.iter_content(8192):
-                f.write(chunk)
-    print("⬇️ Video downloaded.")
-
-    # Duration
-    dur = get_video_duration(video_file)
-
-    # Thumbnail
-    thumb_file = "thumb.jpg"
-    subprocess.run(["ffmpeg","-y","-i",video_file,"-ss",str(dur/2),
-                    "-vframes","1",thumb_file])
-    print("🖼 Thumbnail generated.")
-
-    # Convert & Upload
-    converted = create_quality_versions(video_file)
-    urls = {q: upload_file(p, q, provider) for q,p in converted.items()}
-    thumb_url = upload_file(thumb_file, provider=provider)
-
-    # Update Firestore
-    db.collection(collection_name).document(doc.id).update({
-        "qualities": urls,
-        "thumbnail": thumb_url,
-        "duration": dur,
-        "processed": True,
-        "processedAt": datetime.datetime.now().isoformat(),
-        "storageProvider": provider
-    })
-    print("🔥 Firestore updated.")
+# Pipeline: a background thread streams each download straight into ffmpeg
+# (download overlaps encode inside one pass, no input file on disk) while the
+# main thread uploads and updates Firestore for the previous video. Bounded
+# queue caps disk usage at two encoded output sets.
+encoded_queue = queue.Queue(maxsize=2)
+_QUEUE_DONE = object()
 
-    shutil.rmtree("output_videos", ignore_errors=True)
-    os.remove(video_file)
-    os.remove(thumb_file)
+def encode_worker(docs):
+    # The sentinel must go out even if the worker dies unexpectedly,
+    # or the main thread would block on the queue forever.
+    try:
+        for doc in docs:
+            data = doc.to_dict()
+            url = data.get("url")
+            provider = data.get("storageProvider","Firebase")  # default Firebase
+
+            if not url:
+                print(f"⚠️ Missing URL in {doc.id}")
+                continue
+
+            try:
+                with SESSION.get(url, stream=True, timeout=30) as r:
+                    r.raise_for_status()
+                    converted, thumb_file, dur = create_quality_versions(
+                        r.iter_content(1 << 20))
+            except Exception as e:
+                print(f"⚠️ Download/encode failed for {doc.id}: {e}")
+                continue
+
+            encoded_queue.put((doc, converted, thumb_file, provider, dur))
+    finally:
+        encoded_queue.put(_QUEUE_DONE)
+
+encoder_thread = threading.Thread(target=encode_worker,
+                                  args=(unprocessed_docs,), daemon=True)
+encoder_thread.start()
+
+# Batch Firestore writes: flush every FLUSH_EVERY videos instead of one RPC each
+FLUSH_EVERY = 10
+media_batch = db.batch()
+pending_writes = 0
+pending_log_ids = []
+
+def flush_log_updates(ids):
+    # Server-side append/increment keeps the payload O(1) instead of
+    # resending the whole ever-growing bot_data dict each time.
+    bot_doc.update({
+        f"{runtime_key}.logs": firestore.ArrayUnion(ids),
+        f"{runtime_key}.success_count": firestore.Increment(len(ids)),
+        f"{runtime_key}.total_count": firestore.Increment(len(ids))
+    })
 
-    bot_data[runtime_key]["logs"].append(doc.id)
-    bot_data[runtime_key]["success_count"] += 1
-    bot_data[runtime_key]["total_count"] += 1
-    bot_doc.set(bot_data, merge=True)
+index = 0
+try:
+    while True:
+        item = encoded_queue.get()
+        if item is _QUEUE_DONE:
+            break
+        doc, converted, thumb_file, provider, dur = item
+        index += 1
+        print("="*60)
+        print(f"🚀 Processing {index}/{len(unprocessed_docs)} | ID: {doc.id}")
+        print("🎞 Renditions and thumbnail ready.")
+
+        # Upload (all four artifacts in parallel — upload is I/O-bound).
+        # A failed video is logged and skipped, like in encode_worker — it
+        # stays processed=False and is retried on the next run.
+        try:
+            with ThreadPoolExecutor(max_workers=4) as ex:
+                futures = {q: ex.submit(upload_file, p, q, provider) for q,p in converted.items()}
+                thumb_future = ex.submit(upload_file, thumb_file, None, provider)
+                urls = {q: f.result() for q,f in futures.items()}
+                thumb_url = thumb_future.result()
+        except Exception as e:
+            print(f"⚠️ Upload failed for {doc.id}: {e}")
+            continue
+        finally:
+            # Remove only this video's artifacts — the encoder thread may
+            # already be writing the next set into output_videos/
+            for p in converted.values():
+                os.remove(p)
+            os.remove(thumb_file)
+
+        # Queue Firestore update (committed in batches)
+        media_batch.update(db.collection(collection_name).document(doc.id), {
+            "qualities": urls,
+            "thumbnail": thumb_url,
+            "duration": dur,
+            "processed": True,
+            "processedAt": datetime.datetime.now().isoformat(),
+            "storageProvider": provider
+        })
+        pending_writes += 1
+        print("🔥 Firestore update queued.")
+
+        pending_log_ids.append(doc.id)
+
+        if pending_writes >= FLUSH_EVERY:
+            media_batch.commit()
+            media_batch = db.batch()
+            pending_writes = 0
+            flush_log_updates(pending_log_ids)
+            pending_log_ids = []
+finally:
+    # Commit whatever is pending even if the loop dies — otherwise already
+    # uploaded videos are never marked processed and get redone next run.
+    if pending_writes:
+        media_batch.commit()
+    if pending_log_ids:
+        flush_log_updates(pending_log_ids)
 
 # ========================================
 # End Runtime
@@ -255,10 +461,10 @@ h, rem = divmod(elapsed.total_seconds(), 3600)
 m, s = divmod(rem, 60)
 active_str = f"{int(h)}H-{int(m)}M-{int(s)}S"
 
-bot_data[runtime_key].update({
-    "ended_at": end_time.isoformat(),
-    "active_time": active_str,
-    "status": "completed"
+bot_doc.update({
+    f"{runtime_key}.ended_at": end_time.isoformat(),
+    f"{runtime_key}.active_time": active_str,
+    f"{runtime_key}.status": "completed",
+    "total_runtime_hours": firestore.Increment(elapsed.total_seconds() / 3600)
 })
-bot_doc.set(bot_data, merge=True)
 print(f"✅ {runtime_key} finished. Active {active_str}.")
@@ -1,5 +1,6 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import json
 import os
@@ -44,49 +45,91 @@ else:
 # ------------------------------
 # Copy functions
 # ------------------------------
-def copy_doc_with_subcollections(src_doc_ref, dest_doc_ref):
-    doc_data = src_doc_ref.get().to_dict()
+FIRESTORE_BATCH_LIMIT = 500  # Firestore caps a WriteBatch at 500 writes
+
+class BatchWriter:
+    """Accumulates document writes and commits them in WriteBatch chunks."""
+    def __init__(self, dest_db):
+        self.dest_db = dest_db
+        self.batch = dest_db.batch()
+        self.count = 0
+
+    def set(self, doc_ref, data):
+        self.batch.set(doc_ref, data, merge=True)
+        self.count += 1
+        if self.count >= FIRESTORE_BATCH_LIMIT:
+            self.flush()
+
+    def flush(self):
+        if self.count:
+            self.batch.commit()
+            self.batch = self.dest_db.batch()
+            self.count = 0
+
+def copy_doc_with_subcollections(src_snapshot, dest_doc_ref, writer):
+    # Callers always hold a snapshot already (from stream() or get()),
+    # so copying never needs its own read round-trip. The snapshot also
+    # carries its DocumentReference — no rebuilding source refs by path.
+    doc_data = src_snapshot.to_dict()
     if doc_data:
-        dest_doc_ref.set(doc_data, merge=True)
-    for subcol in src_doc_ref.collections():
+        writer.set(dest_doc_ref, doc_data)
+    for subcol in src_snapshot.reference.collections():
         for subdoc in subcol.stream():
             copy_doc_with_subcollections(
-                src_doc_ref.collection(subcol.id).document(subdoc.id),
-                dest_doc_ref.collection(subcol.id).document(subdoc.id)
+                subdoc,
+                dest_doc_ref.collection(subcol.id).document(subdoc.id),
+                writer
             )
 
 def copy_entire_collection(src_db, dest_db, collection):
     docs = src_db.collection(collection).stream()
+    writer = BatchWriter(dest_db)
     count = 0
     for doc in docs:
         copy_doc_with_subcollections(
-            src_db.collection(collection).document(doc.id),
-            dest_db.collection(collection).document(doc.id)
+            doc,
+            dest_db.collection(collection).document(doc.id),
+            writer
         )
         count += 1
+    writer.flush()
     print(f"✅ Copied {count} documents from '{collection}' including subcollections")
 
 def replicate_doc_to_all(src_db, user_dbs, collection, doc_id=None, op_type="create"):
-    for db_name, dest_db in user_dbs.items():
+    if not user_dbs:
+        return
+
+    def _replicate_one(db_name, dest_db):
         print(f"\n🔹 Replicating {collection}/{doc_id if doc_id else '(all)'} → {db_name}")
         try:
             if op_type == "delete" and doc_id:
                 dest_db.collection(collection).document(doc_id).delete()
                 print(f"🗑️ Deleted {collection}/{doc_id} in {db_name}")
-                continue
+                return
             if doc_id:
                 src_doc = src_db.collection(collection).document(doc_id).get()
                 if src_doc.exists:
+                    writer = BatchWriter(dest_db)
                     copy_doc_with_subcollections(
-                        src_db.collection(collection).document(doc_id),
-                        dest_db.collection(collection).document(doc_id)
+                        src_doc,
+                        dest_db.collection(collection).document(doc_id),
+                        writer
                     )
+                    writer.flush()
             else:
                 copy_entire_collection(src_db, dest_db, collection)
         except Exception as e:
             print(f"❌ Error replicating to {db_name}: {e}")
             traceback.print_exc()
 
+    # Each target DB is an independent I/O-bound client — fan out so wall
+    # time is the slowest destination instead of the sum of all of them
+    with ThreadPoolExecutor(max_workers=len(user_dbs)) as ex:
+        futures = [ex.submit(_replicate_one, db_name, dest_db)
+                   for db_name, dest_db in user_dbs.items()]
+        for fut in futures:
+            fut.result()
+
 def process_logs_for_day(src_db, user_dbs, date_str):
     log_doc_ref = src_db.collection("logs").document(date_str)
     log_doc = log_doc_ref.get()